@@ -1,14 +1,11 @@
 #!/usr/bin/env python3
 import collections
-import optparse
 import os
 import platform
-from string import punctuation
+import re
 import sys
 
-import chpl_comm, chpl_compiler, chpl_platform, overrides
-from compiler_utils import CompVersion, target_compiler_is_prgenv, get_compiler_version
-from utils import memoize, run_command, warning
+from utils import memoize, warning
 
 # This map has a key as a synonym and the value as the LLVM arch/cpu
 # It is intended to map from PrgEnv target cpus (e.g. craype-sandybridge)
@@ -28,30 +25,49 @@ cpu_llvm_synonyms = {
 # cross-compilation is limited to different subarchitectures of the
 # generic machine type.  For example, we can cross compile from
 # sandybridge to broadwell, but not x86_64 to aarch64.
-@memoize
+#
+# uname can't change underneath us, so look it up once at import.
+_NATIVE_MACHINE = platform.uname()[4]
+
 def get_native_machine():
-    return platform.uname()[4]
+    return _NATIVE_MACHINE
+
+_ARM_RE = re.compile(r'^arm-|aarch64|thunderx')
 
 @memoize
 def is_known_arm(cpu):
-    if cpu.startswith("arm-") or ('aarch64' in cpu) or ('thunderx' in cpu):
-        return True
-    else:
-        return False
+    return _ARM_RE.search(cpu) is not None
+
+_X86_ALIASES = frozenset(['amd64', 'x64', 'x86', 'x86-64', 'x86_64'])
 
 # Take a machine name in the same format as uname -m and answer
 # whether or not it is in the x86 family.
 @memoize
 def is_x86_variant(machine):
-    if machine.startswith('i') and machine.endswith('86'):  # e.g. i686
+    if machine in _X86_ALIASES:
         return True
-    if machine in ['amd64', 'x64', 'x86', 'x86-64', 'x86_64']:
+    if machine.startswith('i') and machine.endswith('86'):  # e.g. i686
         return True
     return False
 
+_NATIVE_IS_X86 = is_x86_variant(_NATIVE_MACHINE)
+
+# x86 uses -march= where the others use -mcpu=
+_ARG_NAME_FOR_HOST = 'arch' if _NATIVE_IS_X86 else 'cpu'
+
 class InvalidLocationError(ValueError):
     pass
 
+# The craype-* modules communicate through these; they are fixed for the
+# life of the process.
+@memoize
+def _cray_network():
+    return os.environ.get('CRAYPE_NETWORK_TARGET', 'none')
+
+@memoize
+def _cray_cpu():
+    return os.environ.get('CRAY_CPU_TARGET', 'none')
+
 # We build the module with the lowest common denominator cpu architecture for
 # each platform. This is so that end users can build programs with any
 # compatible cpu architecture loaded and we don't have to build a binary for
@@ -59,51 +75,88 @@ class InvalidLocationError(ValueError):
 # in the gen directory so we need a way to get the proper path no matter what
 # cpu architecture is actually loaded. Note that this MUST be kept in sync with
 # what we have in the module build script.
-def get_module_lcd_cpu(platform_val, cpu):
-    if platform_val == "cray-xc":
-        if is_known_arm(cpu):
-            return "arm-thunderx2"
-        else:
-            return "sandybridge"
-    elif platform_val == "hpe-cray-ex":
-        if is_known_arm(cpu):
-            return "none"    # we don't know what we need here yet
-        else:
-            cray_network = os.environ.get('CRAYPE_NETWORK_TARGET', 'none')
-            if cray_network.startswith("slingshot") or cray_network == "ofi":
-                return "x86-rome"       # We're building on an HPE Cray EX system!
-            else:
-                return "sandybridge"    # We're still building on an XC.
-    elif platform_val == "aarch64":
-        return "arm-thunderx"
+#
+# In particular, the answer can't be upgraded based on what the build machine
+# happens to support (e.g. picking x86-milan on a znver3 node): the module only
+# ships runtimes for these cpus, so any other choice would name a gen/runtime
+# directory that doesn't exist.  Users who want a more specialized runtime
+# should build Chapel themselves with CHPL_TARGET_CPU set.
+@memoize
+def _lcd_cray_xc(cpu):
+    if is_known_arm(cpu):
+        return "arm-thunderx2"
     else:
-        return 'none'
+        return "sandybridge"
+
+@memoize
+def _lcd_hpe_cray_ex(cpu):
+    if is_known_arm(cpu):
+        return "none"    # we don't know what we need here yet
+    else:
+        cray_network = _cray_network()
+        if cray_network.startswith("slingshot") or cray_network == "ofi":
+            return "x86-rome"       # We're building on an HPE Cray EX system!
+        else:
+            return "sandybridge"    # We're still building on an XC.
+
+def _lcd_aarch64(cpu):
+    return "arm-thunderx"
+
+def _lcd_none(cpu):
+    return 'none'
+
+_LCD_DISPATCH = {
+  'cray-xc':     _lcd_cray_xc,
+  'hpe-cray-ex': _lcd_hpe_cray_ex,
+  'aarch64':     _lcd_aarch64,
+}
+
+def get_module_lcd_cpu(platform_val, cpu):
+    return _LCD_DISPATCH.get(platform_val, _lcd_none)(cpu)
+
+# adjust_cpu_for_compiler is memoized per (cpu, flag, get_lcd), so the same
+# warning can otherwise be issued once for each combination
+_seen_warnings = set()
+
+def _warn_once(msg):
+    if msg in _seen_warnings:
+        return
+    _seen_warnings.add(msg)
+    warning(msg)
+
+@memoize
+def _is_prgenv_target():
+    from compiler_utils import target_compiler_is_prgenv
+    return target_compiler_is_prgenv()
 
 # Adjust the cpu based upon compiler support
 @memoize
 def adjust_cpu_for_compiler(cpu, flag, get_lcd):
+    import chpl_compiler, chpl_platform
+
     compiler_val = chpl_compiler.get(flag)
     platform_val = chpl_platform.get(flag)
 
-    isprgenv = flag == 'target' and target_compiler_is_prgenv()
+    isprgenv = flag == 'target' and _is_prgenv_target()
 
     if isprgenv:
-        cray_cpu = os.environ.get('CRAY_CPU_TARGET', 'none')
+        cray_cpu = _cray_cpu()
         if cpu and (cpu != 'none' and cpu != 'unknown' and cpu != cray_cpu):
-            warning("Setting the processor type through environment variables "
-                    "is not supported for cray-prgenv-*. Please use the "
-                    "appropriate craype-* module for your processor type.")
+            _warn_once("Setting the processor type through environment "
+                       "variables is not supported for cray-prgenv-*. Please "
+                       "use the appropriate craype-* module for your "
+                       "processor type.")
         cpu = cray_cpu
         if cpu == 'none':
-            warning("No craype-* processor type module was detected, please "
-                    "load the appropriate one if you want any specialization "
-                    "to occur.")
+            _warn_once("No craype-* processor type module was detected, "
+                       "please load the appropriate one if you want any "
+                       "specialization to occur.")
         if get_lcd:
             cpu = get_module_lcd_cpu(platform_val, cpu)
             if cpu == 'none':
-                warning("Could not detect the lowest common denominator "
-                        "processor type for this platform. You may be unable "
-                        "to use the Chapel compiler")
+                _warn_once("Could not detect the lowest common denominator "
+                           "processor type for this platform. You may be "
+                           "unable to use the Chapel compiler")
         return cpu
     elif 'pgi' in compiler_val:
         return 'none'
@@ -116,15 +169,18 @@ def adjust_cpu_for_compiler(cpu, flag, get_lcd):
 
 @memoize
 def default_cpu(flag):
+    import chpl_comm, chpl_compiler, chpl_platform
+
     comm_val = chpl_comm.get()
     compiler_val = chpl_compiler.get(flag)
     platform_val = chpl_platform.get(flag)
 
     cpu = 'unknown'
 
-    if comm_val == 'none' and ('linux' in platform_val or
-                               platform_val == 'darwin' or
-                               platform_val.startswith('cygwin')):
+    # Chapel's linux platforms are all linux-prefixed (linux64, linux32,
+    # linux_ppc_*, ...), so one prefix check covers them.
+    if comm_val == 'none' and platform_val.startswith(('linux', 'darwin',
+                                                       'cygwin')):
       # Clang cannot detect the architecture for aarch64.  Otherwise,
       # let the backend compiler do the actual feature set detection. We
       # could be more aggressive in setting a precise architecture using
@@ -140,23 +196,39 @@ def default_cpu(flag):
 
     return cpu
 
+# Snapshot of the user's CHPL_HOST_CPU/CHPL_TARGET_CPU settings
+@memoize
+def _overrides():
+    import overrides
+    return {'host': overrides.get('CHPL_HOST_CPU', ''),
+            'target': overrides.get('CHPL_TARGET_CPU', '')}
+
+_CpuTuple = collections.namedtuple('cpu_tuple', ['flag', 'cpu'])
+
 # get_lcd has no effect on non cray systems and is intended to be used to get
 # the correct runtime and gen directory.
-@memoize
+#
+# memoize only caches positional calls, and most callers pass map_to_compiler
+# and get_lcd by keyword, so normalize the arguments before hitting the cache.
 def get(flag, map_to_compiler=False, get_lcd=False):
+    return _get(flag, bool(map_to_compiler), bool(get_lcd))
 
-    cpu_tuple = collections.namedtuple('cpu_tuple', ['flag', 'cpu'])
+@memoize
+def _get(flag, map_to_compiler, get_lcd):
+    # The sibling chplenv modules are imported lazily so that callers that
+    # only need e.g. get_native_machine() don't pay to load them.
+    import chpl_compiler
 
     if not flag or flag == 'host':
-        cpu = overrides.get('CHPL_HOST_CPU', '')
+        cpu = _overrides()['host']
     elif flag == 'target':
-        cpu = overrides.get('CHPL_TARGET_CPU', '')
+        cpu = _overrides()['target']
     else:
         raise InvalidLocationError(flag)
 
     # fast path out for when the user has set arch=none
     if cpu == 'none' or (flag == 'host' and not cpu):
-        return cpu_tuple('none', 'none')
+        return _CpuTuple('none', 'none')
 
     compiler_val = chpl_compiler.get(flag)
 
@@ -167,8 +239,7 @@ def get(flag, map_to_compiler=False, get_lcd=False):
      # support additional cpu synonyms for llvm/gcc/clang
     if map_to_compiler:
         if compiler_val in ('llvm', 'gnu', 'clang'):
-            if cpu in cpu_llvm_synonyms:
-                cpu = cpu_llvm_synonyms[cpu]
+            cpu = cpu_llvm_synonyms.get(cpu, cpu)
 
     # Now, if is not yet set, we should set the default.
     if not cpu:
@@ -176,15 +247,11 @@ def get(flag, map_to_compiler=False, get_lcd=False):
 
     argname = None
     if cpu and cpu != 'none' and cpu != 'unknown':
-        # x86 uses -march= where the others use -mcpu=
-        if is_x86_variant(get_native_machine()):
-            argname = 'arch'
-        else:
-            argname = 'cpu'
+        argname = _ARG_NAME_FOR_HOST
     else:
         argname = 'none'
 
-    return cpu_tuple(argname or 'none', cpu or 'unknown')
+    return _CpuTuple(argname or 'none', cpu or 'unknown')
 
 
 # Returns the default machine.  The flag argument is 'host' or 'target'.
@@ -206,28 +273,74 @@ def get_default_machine(flag):
     return get_native_machine()
 
 
+_USAGE = ("usage: chpl_cpu.py [--host|target] [--comparch] [--compflag] "
+          "[--lcdflag]")
+
+_LONG_OPTS = ('--target', '--host', '--comparch', '--compflag', '--lcdflag',
+              '--help')
+
+def _usage_error(msg):
+    sys.stderr.write("{0}\n\nchpl_cpu.py: error: {1}\n".format(_USAGE, msg))
+    sys.exit(2)
+
+# Resolve a long option the way optparse does: an exact match wins,
+# otherwise any unambiguous prefix is accepted.
+def _match_long_opt(arg):
+    if arg in _LONG_OPTS:
+        return arg
+    matches = [opt for opt in _LONG_OPTS if opt.startswith(arg)]
+    if len(matches) == 1:
+        return matches[0]
+    elif matches:
+        _usage_error("ambiguous option: {0} ({1}?)".format(arg,
+                                                          ", ".join(matches)))
+    _usage_error("no such option: {0}".format(arg))
+
+# This script is run many times over the course of a build, so parse the
+# handful of fixed flags directly instead of constructing an OptionParser.
+# Positional arguments are ignored, as they were with optparse.
 def _main():
-    parser = optparse.OptionParser(usage="usage: %prog [--host|target] "
-                                         "[--compflag] [--lcdflag] "
-                                         "[--specialize]")
-    parser.add_option('--target', dest='flag', action='store_const',
-                      const='target', default='target')
-    parser.add_option('--host', dest='flag', action='store_const',
-                      const='host')
-    parser.add_option('--comparch', dest='map_to_compiler',
-                      action='store_true', default=False)
-    parser.add_option('--compflag', dest='compflag', action='store_true',
-                      default=False)
-    parser.add_option('--lcdflag', dest = 'get_lcd', action='store_true',
-                      default=False)
-    (options, args) = parser.parse_args()
-
-    (flag, cpu) = get(options.flag, options.map_to_compiler,
-                      options.get_lcd)
-
-    if options.compflag:
-        sys.stdout.write("{0}=".format(flag))
-    sys.stdout.write("{0}\n".format(cpu))
+    flag = 'target'
+    map_to_compiler = False
+    compflag = False
+    get_lcd = False
+
+    for arg in sys.argv[1:]:
+        if arg == '--':
+            break
+        if not arg.startswith('-') or arg == '-':
+            continue
+        if arg.startswith('-h'):
+            opt = '--help'
+        elif arg.startswith('--'):
+            (opt, eq, _) = arg.partition('=')
+            opt = _match_long_opt(opt)
+            if eq:
+                _usage_error("{0} option does not take a value".format(opt))
+        else:
+            _usage_error("no such option: {0}".format(arg[:2]))
+
+        if opt == '--target':
+            flag = 'target'
+        elif opt == '--host':
+            flag = 'host'
+        elif opt == '--comparch':
+            map_to_compiler = True
+        elif opt == '--compflag':
+            compflag = True
+        elif opt == '--lcdflag':
+            get_lcd = True
+        else:
+            sys.stdout.write("{0}\n".format(_USAGE))
+            sys.exit(0)
+
+    (flag, cpu) = get(flag, map_to_compiler, get_lcd)
+
+    if compflag:
+        out = "{0}={1}\n".format(flag, cpu)
+    else:
+        out = "{0}\n".format(cpu)
+    sys.stdout.write(out)
 
 if __name__ == '__main__':
     _main()